@@ -1,9 +1,12 @@
 import click  # <--- NEW: Switch from argparse to click
+import csv
+import json
 import os
+import re
 import subprocess
 import shutil
 import yaml
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 # Import your modules
 from spec_generator.importers.spss.parser import SpssParser
@@ -65,7 +68,458 @@ def run_command(cmd: List[str], log_file: str):
     print(f"  ⚙️  Executed: {cmd[0]} -> {os.path.basename(log_file)}")
 
 
-def compile_pipeline(manifest_path: str, pspp_cmd: str = "pspp", rscript_cmd: str = "Rscript"):
+# --- RUNTIME PROFILING ---
+# R helpers prepended to the instrumented script. Each profiled block is passed
+# as a lazy argument, so it still evaluates in the global environment and its
+# assignments stay visible to the blocks that follow.
+R_PROFILE_PRELUDE = """# === ETL COMPILER: RUNTIME PROFILING (instrumented build) ===
+.etl_profile_path <- {profile_path}
+write.csv(
+  data.frame(op_id = character(), elapsed_sec = numeric(), rows = numeric(),
+             mem_mb = numeric(), mem_delta_mb = numeric()),
+  .etl_profile_path, row.names = FALSE
+)
+.etl_mem_mb <- function() sum(gc()[, 2])
+.etl_rows <- function(value, outputs) {{
+  if (is.data.frame(value)) return(nrow(value))
+  for (name in rev(outputs)) {{
+    if (exists(name, envir = globalenv())) {{
+      candidate <- get(name, envir = globalenv())
+      if (is.data.frame(candidate)) return(nrow(candidate))
+    }}
+  }}
+  NA
+}}
+.etl_profile <- function(op_id, outputs, expr) {{
+  mem_before <- .etl_mem_mb()
+  started <- proc.time()[["elapsed"]]
+  value <- expr
+  elapsed <- proc.time()[["elapsed"]] - started
+  mem_after <- .etl_mem_mb()
+  write.table(
+    data.frame(op_id = op_id, elapsed_sec = elapsed,
+               rows = .etl_rows(value, outputs),
+               mem_mb = mem_after, mem_delta_mb = mem_after - mem_before),
+    .etl_profile_path, sep = ",", append = TRUE,
+    row.names = FALSE, col.names = FALSE
+  )
+  invisible(value)
+}}
+# === END PROFILING PRELUDE ===
+"""
+
+PIPELINE_BLOCK_ID = "pipeline"
+HEADER_BLOCK_ID = "pipeline_header"
+FOOTER_BLOCK_ID = "pipeline_footer"
+SCRIPT_BLOCK_IDS = (PIPELINE_BLOCK_ID, HEADER_BLOCK_ID, FOOTER_BLOCK_ID)
+
+
+def _r_string(value: str) -> str:
+    """Quotes a value as an R string literal (JSON escapes are valid R escapes)."""
+    return json.dumps(str(value))
+
+
+def _r_string_vector(values: List[str]) -> str:
+    if not values:
+        return "character()"
+    return "c(" + ", ".join(_r_string(v) for v in values) + ")"
+
+
+def _significant(lines: List[str]) -> List[str]:
+    return [line.rstrip() for line in lines if line.strip()]
+
+
+def _common_prefix(a: List[str], b: List[str]) -> int:
+    n = 0
+    while n < len(a) and n < len(b) and a[n] == b[n]:
+        n += 1
+    return n
+
+
+def _generate_lines(pipeline: Pipeline, operations: list) -> List[str]:
+    subset = Pipeline(metadata=pipeline.metadata, datasets=pipeline.datasets, operations=operations)
+    return RGenerator(subset).generate().splitlines()
+
+
+def segment_by_generator(r_code: str, pipeline: Pipeline) -> Optional[dict]:
+    """
+    Asks RGenerator for each operation on its own and strips the boilerplate
+    an empty pipeline produces. The split is only trusted if the pieces
+    reassemble into `r_code`; generators that fuse operations (e.g. into one
+    `%>%` chain) fail that check and return None.
+    """
+    try:
+        empty = _generate_lines(pipeline, [])
+        singles = [(op, _generate_lines(pipeline, [op])) for op in pipeline.operations]
+    except Exception:
+        return None
+    if not singles:
+        return None
+
+    prefix = min(_common_prefix(empty, single) for _, single in singles)
+    suffix = min(
+        _common_prefix(empty[prefix:][::-1], single[prefix:][::-1]) for _, single in singles
+    )
+
+    blocks = []
+    for op, single in singles:
+        body = single[prefix:len(single) - suffix]
+        blocks.append({"id": op.id, "outputs": list(op.outputs), "lines": body, "covers": [op.id]})
+
+    segments = {
+        "header": empty[:prefix],
+        "blocks": blocks,
+        "footer": empty[len(empty) - suffix:] if suffix else [],
+    }
+    rebuilt = segments["header"] + [l for b in blocks for l in b["lines"]] + segments["footer"]
+    if _significant(rebuilt) != _significant(r_code.splitlines()):
+        return None
+    return segments
+
+
+def find_op_markers(lines: List[str], pipeline: Pipeline) -> List[Tuple[int, object]]:
+    """
+    Locates the dedicated marker comment (a line holding only `# <op_id>`)
+    for each operation. Returns (line index, op) pairs in script order.
+    """
+    markers = {}
+    for op in pipeline.operations:
+        pattern = re.compile(rf"^\s*#\s*{re.escape(op.id)}\s*$")
+        for idx, line in enumerate(lines):
+            if pattern.match(line):
+                # One block per line: a second op claiming the same marker is dropped
+                markers.setdefault(idx, op)
+                break
+    return sorted(markers.items(), key=lambda m: m[0])
+
+
+def segment_by_markers(r_code: str, pipeline: Pipeline) -> Optional[dict]:
+    """
+    Splits `r_code` at `# <op_id>` marker lines. Ops without a marker are
+    assumed to sit in the block of the nearest marked op before them (or the
+    header) and are recorded as covered by that block.
+    """
+    lines = r_code.splitlines()
+    markers = find_op_markers(lines, pipeline)
+    if not markers:
+        return None
+
+    marked = {op.id for _, op in markers}
+    covers = {HEADER_BLOCK_ID: []}
+    owner = HEADER_BLOCK_ID
+    for op in pipeline.operations:
+        if op.id in marked:
+            owner = op.id
+            covers[owner] = [op.id]
+        else:
+            covers[owner].append(op.id)
+
+    blocks = []
+    for i, (start, op) in enumerate(markers):
+        end = markers[i + 1][0] if i + 1 < len(markers) else len(lines)
+        blocks.append({
+            "id": op.id,
+            "outputs": list(op.outputs),
+            "lines": lines[start:end],
+            "covers": covers[op.id],
+        })
+    return {
+        "header": lines[:markers[0][0]],
+        "header_covers": covers[HEADER_BLOCK_ID],
+        "blocks": blocks,
+        "footer": [],
+    }
+
+
+def instrument_r_code(r_code: str, pipeline: Pipeline, profile_path: str, per_operation: bool = True) -> Tuple[str, dict]:
+    """
+    Wraps each operation's block of generated R in a timing/row/memory probe.
+
+    Blocks come from `segment_by_generator`, then `segment_by_markers`. If
+    neither applies (or `per_operation` is off) the whole script is profiled
+    as a single `pipeline` block. Code outside the op blocks is timed as
+    `pipeline_header` / `pipeline_footer`.
+
+    Returns the script and a layout describing which ops each block covers.
+    """
+    segments, method, reason = None, None, None
+    if per_operation:
+        segments = segment_by_generator(r_code, pipeline)
+        method = "generator" if segments else None
+        if segments is None:
+            segments = segment_by_markers(r_code, pipeline)
+            method = "markers" if segments else None
+        if segments is None:
+            reason = "no_op_markers"
+    else:
+        reason = "disabled"
+
+    if segments is None:
+        segments = {
+            "header": [],
+            "blocks": [{
+                "id": PIPELINE_BLOCK_ID,
+                "outputs": [],
+                "lines": r_code.splitlines(),
+                "covers": [op.id for op in pipeline.operations],
+            }],
+            "footer": [],
+        }
+
+    blocks = list(segments["blocks"])
+    if _significant(segments["header"]):
+        blocks.insert(0, {
+            "id": HEADER_BLOCK_ID,
+            "outputs": [],
+            "lines": segments["header"],
+            "covers": segments.get("header_covers", []),
+        })
+    if _significant(segments["footer"]):
+        blocks.append({"id": FOOTER_BLOCK_ID, "outputs": [], "lines": segments["footer"], "covers": []})
+
+    out = [R_PROFILE_PRELUDE.format(profile_path=_r_string(profile_path))]
+    for block in blocks:
+        out.append(f".etl_profile({_r_string(block['id'])}, {_r_string_vector(block['outputs'])}, {{")
+        out.extend(block["lines"])
+        out.append("})")
+
+    layout = {
+        "granularity": "operation" if method else "pipeline",
+        "segmentation": method,
+        "blocks": {block["id"]: block["covers"] for block in blocks},
+    }
+    if reason:
+        layout["reason"] = reason
+    return "\n".join(out) + "\n", layout
+
+
+def r_script_parses(r_path: str, rscript_cmd: str = "Rscript") -> Optional[bool]:
+    """Asks R whether a script is syntactically valid. None if R is unavailable."""
+    check = f"invisible(parse(file = {_r_string(os.path.abspath(r_path))}))"
+    try:
+        result = subprocess.run(
+            [rscript_cmd, "-e", check],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        )
+    except FileNotFoundError:
+        return None
+    return result.returncode == 0
+
+
+def _is_comment(text: str) -> bool:
+    return re.match(r"(\*|COMMENT\b)", text, re.IGNORECASE) is not None
+
+
+def split_statements(sps_code: str) -> List[Tuple[int, int, str]]:
+    """
+    Splits SPSS syntax into commands, returning (first line, last line, text)
+    with 1-based line numbers. A command ends at a blank line or at a period
+    followed by whitespace or end of input, outside of quotes. Comments (`*`
+    and COMMENT) ignore quotes and only end at a period closing a line.
+    """
+    statements = []
+    current = None
+    quote = None
+
+    def _close():
+        nonlocal current, quote
+        statements.append((current["first"], current["last"], "".join(current["text"]).strip()))
+        current, quote = None, None
+
+    for number, line in enumerate(sps_code.splitlines(), start=1):
+        if not line.strip():
+            if current is not None:
+                _close()
+            continue
+
+        for i, ch in enumerate(line):
+            if current is None:
+                if ch.isspace():
+                    continue
+                current = {"first": number, "last": number, "text": [], "comment": _is_comment(line[i:])}
+            current["text"].append(ch)
+            current["last"] = number
+
+            if current["comment"]:
+                if ch == "." and not line[i + 1:].strip():
+                    _close()
+            elif quote:
+                if ch == quote:
+                    quote = None
+            elif ch in ("'", '"'):
+                quote = ch
+            elif ch == "." and (i + 1 == len(line) or line[i + 1].isspace()):
+                _close()
+
+        if current is not None:
+            current["text"].append("\n")
+
+    if current is not None:
+        _close()
+    return statements
+
+
+def map_source_lines(sps_code: str, raw_pipeline: Pipeline) -> Dict[str, List[int]]:
+    """
+    Maps raw op ids to the SPSS lines of the command they came from.
+
+    The parser emits one raw op per non-comment command, in source order
+    (see bmi_gold_standard/). When the counts disagree that assumption does
+    not hold, so no mapping is returned rather than a misaligned one.
+    """
+    commands = [s for s in split_statements(sps_code) if not _is_comment(s[2])]
+    if len(commands) != len(raw_pipeline.operations):
+        return {}
+    return {
+        op.id: list(range(first, last + 1))
+        for op, (first, last, _) in zip(raw_pipeline.operations, commands)
+    }
+
+
+def read_profile(profile_path: str) -> Dict[str, dict]:
+    """
+    Loads the CSV written by the instrumented script, keyed by op id.
+    Repeated samples for an op (e.g. a block run in a loop) are accumulated.
+    """
+    if not os.path.exists(profile_path):
+        return {}
+
+    def _num(value: str):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _add(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a + b
+
+    samples = {}
+    with open(profile_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            sample = samples.setdefault(row["op_id"], {
+                "calls": 0,
+                "elapsed_sec": None,
+                "rows": None,
+                "mem_mb": None,
+                "mem_delta_mb": None,
+            })
+            sample["calls"] += 1
+            sample["elapsed_sec"] = _add(sample["elapsed_sec"], _num(row["elapsed_sec"]))
+            sample["mem_delta_mb"] = _add(sample["mem_delta_mb"], _num(row["mem_delta_mb"]))
+            # Rows reflect the latest run; memory keeps the peak
+            rows = _num(row["rows"])
+            if rows is not None:
+                sample["rows"] = rows
+            mem = _num(row["mem_mb"])
+            if mem is not None:
+                sample["mem_mb"] = mem if sample["mem_mb"] is None else max(sample["mem_mb"], mem)
+    return samples
+
+
+def trace_raw_ops(op, raw_pipeline: Pipeline, owned_ids: Optional[set] = None) -> List[str]:
+    """
+    Returns the raw ops an optimized op was derived from, in source order.
+
+    Walks the raw dataflow graph back from the op's outputs until it reaches
+    the op's inputs, so the middle of a collapsed batch is included. Raw ops
+    that survived optimization under their own id (`owned_ids`) belong to
+    that op and stop the walk.
+    """
+    owned_ids = owned_ids or set()
+    producers = {}
+    for raw in raw_pipeline.operations:
+        for dataset in raw.outputs:
+            producers[dataset] = raw
+
+    found = {raw.id for raw in raw_pipeline.operations if raw.id == op.id}
+    stop = set(op.inputs)
+    pending = [d for d in op.outputs if d not in stop]
+    seen = set()
+    while pending:
+        dataset = pending.pop()
+        if dataset in seen:
+            continue
+        seen.add(dataset)
+        raw = producers.get(dataset)
+        if raw is None or (raw.id != op.id and raw.id in owned_ids):
+            continue
+        found.add(raw.id)
+        pending.extend(d for d in raw.inputs if d not in stop)
+
+    return [raw.id for raw in raw_pipeline.operations if raw.id in found]
+
+
+def build_profile_report(samples: Dict[str, dict], raw_pipeline: Pipeline, optimized_pipeline: Pipeline, source_lines: Optional[Dict[str, List[int]]] = None, layout: Optional[dict] = None) -> dict:
+    """
+    Joins runtime samples back to the optimized topology, the raw ops each
+    optimized op was derived from, and (via `source_lines`, see
+    `map_source_lines`) the SPSS lines those raw ops came from.
+
+    `layout` is the block layout returned by `instrument_r_code`; it records
+    which ops were timed inside another op's (or the whole script's) block.
+    """
+    source_lines = source_lines or {}
+    layout = layout or {}
+    total = sum(s["elapsed_sec"] or 0.0 for s in samples.values())
+    owned_ids = {op.id for op in optimized_pipeline.operations}
+
+    blocks = layout.get("blocks", {})
+    block_of = {}
+    for block_id, covered in blocks.items():
+        for op_id in covered:
+            block_of[op_id] = block_id
+
+    operations = []
+    for op in optimized_pipeline.operations:
+        sample = samples.get(op.id)
+        raw_ops = trace_raw_ops(op, raw_pipeline, owned_ids)
+        entry = {
+            "op_id": op.id,
+            "type": op.type.name,
+            "inputs": list(op.inputs),
+            "outputs": list(op.outputs),
+            "raw_ops": raw_ops,
+            "source_lines": sorted({
+                line for raw_id in raw_ops for line in source_lines.get(raw_id, [])
+            }),
+            "profiled": sample is not None,
+        }
+        block_id = block_of.get(op.id, op.id)
+        if block_id != op.id:
+            entry["included_in"] = block_id
+        elif len(blocks.get(block_id, [])) > 1:
+            entry["covered_ops"] = blocks[block_id]
+        if sample:
+            entry.update(sample)
+            if total and sample["elapsed_sec"] is not None:
+                entry["share"] = round(sample["elapsed_sec"] / total, 4)
+        operations.append(entry)
+
+    operations.sort(key=lambda e: e.get("elapsed_sec") or 0.0, reverse=True)
+
+    report = {
+        "total_elapsed_sec": total,
+        "granularity": layout.get("granularity", "pipeline" if PIPELINE_BLOCK_ID in samples else "operation"),
+        "source_mapping": "statement_order" if source_lines else "unavailable",
+    }
+    for key in ("segmentation", "reason"):
+        if layout.get(key):
+            report[key] = layout[key]
+    report["operations"] = operations
+    # Time spent outside the op blocks (or in the whole script, when there are none)
+    for block_id in SCRIPT_BLOCK_IDS:
+        if block_id in samples:
+            report[block_id] = samples[block_id]
+    return report
+
+
+def compile_pipeline(manifest_path: str, pspp_cmd: str = "pspp", rscript_cmd: str = "Rscript", profile: bool = False):
     # 0. Setup
     print(f"🚀 Starting V&V Compilation Cycle...")
     
@@ -148,6 +602,40 @@ def compile_pipeline(manifest_path: str, pspp_cmd: str = "pspp", rscript_cmd: st
         os.path.join(artifacts.verification_dir, "05_target_verification.txt")
     )
 
+    # Profiling runs a separate instrumented copy; pipeline.R stays clean.
+    if profile:
+        profile_path = os.path.abspath(
+            os.path.join(artifacts.verification_dir, "05_runtime_profile.csv")
+        )
+        instrumented_path = os.path.join(artifacts.verification_dir, "04_instrumented_code.R")
+        instrumented, layout = instrument_r_code(r_code, optimized_pipeline, profile_path)
+        artifacts.save_text("04_instrumented_code.R", instrumented)
+        if layout["granularity"] == "operation" and r_script_parses(instrumented_path, rscript_cmd) is False:
+            instrumented, layout = instrument_r_code(
+                r_code, optimized_pipeline, profile_path, per_operation=False
+            )
+            layout["reason"] = "instrumented_script_does_not_parse"
+            artifacts.save_text("04_instrumented_code.R", instrumented)
+        if layout["granularity"] == "pipeline":
+            print(f"  ⚠️  No per-operation blocks ({layout['reason']}); profiling whole script instead")
+
+        run_command(
+            [rscript_cmd, instrumented_path],
+            os.path.join(artifacts.verification_dir, "05_profile_run.txt")
+        )
+
+        samples = read_profile(profile_path)
+        report = build_profile_report(
+            samples, raw_pipeline, optimized_pipeline,
+            source_lines=map_source_lines(sps_code, raw_pipeline),
+            layout=layout
+        )
+        artifacts.save_text(
+            "05_profile_report.yaml",
+            yaml.safe_dump(report, sort_keys=False, default_flow_style=None)
+        )
+        print(f"  ⏱️  Profiled {len(samples)} blocks ({report['total_elapsed_sec']:.3f}s total)")
+
     print("\n✅ V&V Cycle Complete.")
 
 # --- CLI ENTRY POINT ---
@@ -155,12 +643,13 @@ def compile_pipeline(manifest_path: str, pspp_cmd: str = "pspp", rscript_cmd: st
 @click.option('--manifest', required=True, help='Path to manifest file (.yaml) or direct SPSS script (.sps)')
 @click.option('--pspp-cmd', default='pspp', show_default=True, help='PSPP executable or wrapper command')
 @click.option('--rscript-cmd', default='Rscript', show_default=True, help='Rscript executable or wrapper command')
-def build(manifest, pspp_cmd, rscript_cmd):
+@click.option('--profile', is_flag=True, default=False, help='Run an instrumented R script and report per-operation runtime')
+def build(manifest, pspp_cmd, rscript_cmd, profile):
     """
     Entry point for the compiler CLI.
     """
     try:
-        compile_pipeline(manifest, pspp_cmd=pspp_cmd, rscript_cmd=rscript_cmd)
+        compile_pipeline(manifest, pspp_cmd=pspp_cmd, rscript_cmd=rscript_cmd, profile=profile)
     except Exception as e:
         print(f"❌ Compiler Error: {e}")
         # Re-raise so Pytest sees the failure
@@ -0,0 +1,445 @@
+import os
+import re
+import subprocess
+import pytest
+import yaml
+from pathlib import Path
+from types import SimpleNamespace
+from src import compiler
+from src.compiler import (
+    instrument_r_code,
+    read_profile,
+    build_profile_report,
+    map_source_lines,
+    split_statements,
+    r_script_parses,
+    compile_pipeline,
+)
+
+GOLD_DIR = Path(__file__).resolve().parents[2] / "bmi_gold_standard"
+
+
+def _op(op_id, inputs, outputs, op_type="COMPUTE_COLUMNS"):
+    return SimpleNamespace(
+        id=op_id,
+        type=SimpleNamespace(name=op_type),
+        inputs=inputs,
+        outputs=outputs,
+        parameters={},
+    )
+
+
+class StepGenerator:
+    """Emits one self-contained line per op, like a non-fusing generator."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def generate(self):
+        lines = ["library(tidyverse)", ""]
+        for op in self.pipeline.operations:
+            lines.append(f"{op.outputs[0]} <- step({op.id!r})")
+        lines.append("message('done')")
+        return "\n".join(lines) + "\n"
+
+
+class ChainGenerator(StepGenerator):
+    """Fuses every op into a single `%>%` chain."""
+
+    def generate(self):
+        steps = " %>%\n  ".join(f"step({op.id!r})" for op in self.pipeline.operations)
+        return f"library(tidyverse)\nresult <- tibble() %>%\n  {steps}\n"
+
+
+@pytest.fixture
+def markers_only(monkeypatch):
+    """Takes RGenerator out of the picture so only marker lines can split blocks."""
+    monkeypatch.setattr(compiler, "segment_by_generator", lambda *a: None)
+
+
+@pytest.fixture
+def fake_generator(monkeypatch):
+    monkeypatch.setattr(compiler, "Pipeline", lambda **kw: SimpleNamespace(**kw))
+    monkeypatch.setattr(compiler, "RGenerator", StepGenerator)
+
+
+def _pipeline(*ops):
+    return SimpleNamespace(metadata={}, datasets=[], operations=list(ops))
+
+
+@pytest.fixture
+def gold_raw():
+    """The raw topology SpecGen produced for bmi_gold_standard/bmi_pipeline.sps."""
+    data = yaml.safe_load((GOLD_DIR / "bmi_pipeline.yaml").read_text())
+    return SimpleNamespace(operations=[
+        _op(o["id"], o["inputs"], o["outputs"], o["type"].upper())
+        for o in data["operations"]
+    ])
+
+
+@pytest.fixture
+def gold_optimized(gold_raw):
+    """op_002..op_005 collapsed into a single batch that keeps op_002's id."""
+    ops = gold_raw.operations
+    batch = _op("op_002_compute", ["source_data.csv"], ["ds_004_recode"])
+    return SimpleNamespace(operations=[ops[0], batch] + ops[5:])
+
+
+def test_generator_split_wraps_each_operation(fake_generator):
+    """
+    Blocks taken from RGenerator output one op at a time, with the library
+    header and trailing code timed separately.
+    """
+    pipeline = _pipeline(
+        _op("op_001_load", [], ["ds1"]),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+    )
+
+    instrumented, layout = instrument_r_code(StepGenerator(pipeline).generate(), pipeline, "/tmp/profile.csv")
+
+    assert layout["granularity"] == "operation"
+    assert layout["segmentation"] == "generator"
+    assert list(layout["blocks"]) == ["pipeline_header", "op_001_load", "op_002_compute", "pipeline_footer"]
+    assert '.etl_profile("op_001_load", c("ds1"), {\nds1 <- step(\'op_001_load\')\n})' in instrumented
+    assert '.etl_profile("pipeline_header", character(), {\nlibrary(tidyverse)' in instrumented
+    assert ".etl_profile(\"pipeline_footer\", character(), {\nmessage('done')" in instrumented
+
+
+def test_fused_generator_output_is_not_split(monkeypatch, fake_generator):
+    """
+    A `%>%` chain does not reassemble from single-op output and has no markers.
+    """
+    monkeypatch.setattr(compiler, "RGenerator", ChainGenerator)
+    pipeline = _pipeline(
+        _op("op_001_load", [], ["ds1"]),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+    )
+
+    instrumented, layout = instrument_r_code(ChainGenerator(pipeline).generate(), pipeline, "/tmp/profile.csv")
+
+    assert layout["granularity"] == "pipeline"
+    assert layout["reason"] == "no_op_markers"
+    assert layout["blocks"] == {"pipeline": ["op_001_load", "op_002_compute"]}
+    assert instrumented.count(".etl_profile(\"") == 1
+
+
+def test_each_operation_is_wrapped_by_op_id(markers_only):
+    """
+    Verify that every dedicated marker line becomes its own profiled block.
+    """
+    pipeline = _pipeline(
+        _op("op_001_load", [], ["ds1"]),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+    )
+    r_code = (
+        "library(tidyverse)\n"
+        "# op_001_load\n"
+        "ds1 <- read_csv('data.csv')\n"
+        "# op_002_compute\n"
+        "ds2 <- ds1 %>% mutate(x = 1)\n"
+    )
+
+    instrumented, layout = instrument_r_code(r_code, pipeline, "/tmp/profile.csv")
+
+    assert layout["segmentation"] == "markers"
+    assert '.etl_profile("op_001_load", c("ds1"), {' in instrumented
+    assert '.etl_profile("op_002_compute", c("ds2"), {' in instrumented
+    # Header code is timed on its own
+    assert instrumented.index('.etl_profile("pipeline_header"') < instrumented.index("library(tidyverse)")
+    assert instrumented.index("library(tidyverse)") < instrumented.index('.etl_profile("op_001_load"')
+
+
+def test_unmarked_op_is_attributed_to_enclosing_block(markers_only):
+    """
+    An op without a marker runs inside the previous op's block; the report
+    must say so rather than charging that op silently.
+    """
+    pipeline = _pipeline(
+        _op("op_001_load", [], ["ds1"]),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+        _op("op_003_exec", ["ds2"], ["ds3"]),
+    )
+    r_code = "# op_001_load\na <- 1\nb <- a + 1\n# op_003_exec\nc <- b\n"
+
+    _, layout = instrument_r_code(r_code, pipeline, "/tmp/profile.csv")
+    samples = {
+        "op_001_load": {"calls": 1, "elapsed_sec": 1.0, "rows": None, "mem_mb": 1.0, "mem_delta_mb": 0.0},
+        "op_003_exec": {"calls": 1, "elapsed_sec": 1.0, "rows": None, "mem_mb": 1.0, "mem_delta_mb": 0.0},
+    }
+    report = build_profile_report(samples, pipeline, pipeline, layout=layout)
+    entries = {e["op_id"]: e for e in report["operations"]}
+
+    assert layout["blocks"]["op_001_load"] == ["op_001_load", "op_002_compute"]
+    assert entries["op_001_load"]["covered_ops"] == ["op_001_load", "op_002_compute"]
+    assert entries["op_002_compute"]["included_in"] == "op_001_load"
+    assert entries["op_002_compute"]["profiled"] is False
+    assert "covered_ops" not in entries["op_003_exec"]
+
+
+def test_op_ids_outside_marker_lines_are_ignored(markers_only):
+    """
+    A header listing every op id must not be mistaken for the block markers.
+    """
+    pipeline = _pipeline(
+        _op("op_001_load", [], ["ds1"]),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+    )
+    r_code = (
+        "# Generated from op_001_load, op_002_compute\n"
+        "library(tidyverse)\n"
+        "# op_001_load\n"
+        "ds1 <- read_csv('data.csv')\n"
+        "ds2 <- ds1 %>% mutate(x = 1) # op_002_compute\n"
+    )
+
+    instrumented, layout = instrument_r_code(r_code, pipeline, "/tmp/profile.csv")
+
+    assert list(layout["blocks"]) == ["pipeline_header", "op_001_load"]
+    assert instrumented.index("library(tidyverse)") < instrumented.index('.etl_profile("op_001_load"')
+
+
+def test_no_markers_falls_back_to_pipeline_block(tmp_path, markers_only):
+    """
+    Without op markers the whole script is timed as one `pipeline` block.
+    """
+    pipeline = _pipeline(_op("op_001_load", [], ["ds1"]))
+
+    instrumented, layout = instrument_r_code("library(tidyverse)\nds1 <- tibble()\n", pipeline, "/tmp/profile.csv")
+    assert '.etl_profile("pipeline", character(), {' in instrumented
+
+    profile_csv = tmp_path / "profile.csv"
+    profile_csv.write_text(
+        '"op_id","elapsed_sec","rows","mem_mb","mem_delta_mb"\n'
+        '"pipeline",2.5,NA,40,3\n'
+    )
+    report = build_profile_report(read_profile(str(profile_csv)), pipeline, pipeline, layout=layout)
+
+    assert report["granularity"] == "pipeline"
+    assert report["reason"] == "no_op_markers"
+    assert report["pipeline"]["elapsed_sec"] == pytest.approx(2.5)
+    assert report["operations"][0]["profiled"] is False
+    assert report["operations"][0]["included_in"] == "pipeline"
+
+
+def test_r_strings_are_escaped(markers_only):
+    """
+    Quotes and backslashes in paths or dataset ids must not break the R script.
+    """
+    pipeline = _pipeline(_op("op_001_load", [], ['odd"name\\ds']))
+
+    instrumented, _ = instrument_r_code("# op_001_load\nx <- 1\n", pipeline, 'C:\\dist\\"profile".csv')
+
+    assert '.etl_profile_path <- "C:\\\\dist\\\\\\"profile\\".csv"' in instrumented
+    assert 'c("odd\\"name\\\\ds")' in instrumented
+
+
+def test_unparseable_instrumentation_is_detected(tmp_path, monkeypatch):
+    """
+    Verify the syntax probe reports failures and tolerates a missing Rscript.
+    """
+    script = tmp_path / "script.R"
+    script.write_text("x <- (\n")
+
+    monkeypatch.setattr(
+        compiler.subprocess, "run",
+        lambda *a, **k: subprocess.CompletedProcess(a, 1, stdout="Error: unexpected end of input")
+    )
+    assert r_script_parses(str(script)) is False
+
+    def _missing(*a, **k):
+        raise FileNotFoundError
+    monkeypatch.setattr(compiler.subprocess, "run", _missing)
+    assert r_script_parses(str(script)) is None
+
+
+def test_missing_or_empty_profile(tmp_path, gold_raw):
+    """
+    A failed R run leaves no samples; the report still lists every op.
+    """
+    empty_csv = tmp_path / "empty.csv"
+    empty_csv.write_text("")
+
+    assert read_profile(str(tmp_path / "missing.csv")) == {}
+    assert read_profile(str(empty_csv)) == {}
+
+    report = build_profile_report({}, gold_raw, gold_raw)
+    assert report["total_elapsed_sec"] == 0
+    assert all(e["profiled"] is False and "share" not in e for e in report["operations"])
+
+
+def test_repeated_samples_are_accumulated(tmp_path):
+    profile_csv = tmp_path / "profile.csv"
+    profile_csv.write_text(
+        '"op_id","elapsed_sec","rows","mem_mb","mem_delta_mb"\n'
+        '"op_002_compute",1.0,10,40,1\n'
+        '"op_002_compute",0.5,12,45,2\n'
+    )
+
+    sample = read_profile(str(profile_csv))["op_002_compute"]
+
+    assert sample["calls"] == 2
+    assert sample["elapsed_sec"] == pytest.approx(1.5)
+    assert sample["rows"] == 12
+    assert sample["mem_mb"] == 45
+    assert sample["mem_delta_mb"] == pytest.approx(3)
+
+
+def test_source_lines_follow_statement_order(gold_raw):
+    """
+    Raw ops map onto the non-comment SPSS commands they were parsed from.
+    """
+    sps_code = (GOLD_DIR / "bmi_pipeline.sps").read_text()
+
+    lines = map_source_lines(sps_code, gold_raw)
+
+    assert lines["op_001_load"] == list(range(2, 13))
+    assert lines["op_002_compute"] == [16]
+    assert lines["op_005_recode"] == [25, 26, 27, 28, 29]
+    assert lines["op_011_save"][0] == 57
+    # Counts that disagree mean the order can't be trusted
+    assert map_source_lines(sps_code + "\nEXECUTE.\n", gold_raw) == {}
+
+
+def test_comments_do_not_swallow_commands():
+    """
+    Apostrophes inside comments, and comments closed by a blank line, must
+    leave the following commands intact.
+    """
+    apostrophe = split_statements("* Don't do this.\nCOMPUTE x = 1.\nEXECUTE.\n")
+    assert [(first, last) for first, last, _ in apostrophe] == [(1, 1), (2, 2), (3, 3)]
+
+    blank_line = split_statements("* note\n\nCOMPUTE x = 1.")
+    assert [(first, last) for first, last, _ in blank_line] == [(1, 1), (3, 3)]
+    assert blank_line[1][2] == "COMPUTE x = 1."
+
+
+def test_blank_line_ends_a_command():
+    statements = split_statements("COMPUTE x = 1\n\nEXECUTE.\n")
+
+    assert [(first, last) for first, last, _ in statements] == [(1, 1), (3, 3)]
+
+
+def test_collapsed_batch_joins_every_raw_op(tmp_path, gold_raw, gold_optimized):
+    """
+    The middle of a collapsed batch (op_003, op_004) must be attributed to it.
+    """
+    sps_code = (GOLD_DIR / "bmi_pipeline.sps").read_text()
+    profile_csv = tmp_path / "profile.csv"
+    profile_csv.write_text(
+        '"op_id","elapsed_sec","rows","mem_mb","mem_delta_mb"\n'
+        '"op_001_load",0.5,10,40,2\n'
+        '"op_002_compute",1.5,10,41,1\n'
+    )
+
+    report = build_profile_report(
+        read_profile(str(profile_csv)), gold_raw, gold_optimized,
+        source_lines=map_source_lines(sps_code, gold_raw)
+    )
+
+    hottest = report["operations"][0]
+    assert report["source_mapping"] == "statement_order"
+    assert hottest["op_id"] == "op_002_compute"
+    assert hottest["share"] == pytest.approx(0.75)
+    assert hottest["raw_ops"] == ["op_002_compute", "op_003_exec", "op_004_generic", "op_005_recode"]
+    assert hottest["source_lines"] == [16, 17, 24, 25, 26, 27, 28, 29]
+
+    # Ops downstream of the batch keep only themselves
+    tail = next(e for e in report["operations"] if e["op_id"] == "op_006_exec")
+    assert tail["raw_ops"] == ["op_006_exec"]
+    assert tail["source_lines"] == [30]
+    assert "share" not in tail
+
+
+def _run_profiled(tmp_path, monkeypatch, generator, parses):
+    """
+    Drives compile_pipeline(profile=True) with the sibling packages and R
+    replaced, returning the commands run and the verification directory.
+    """
+    ops = [
+        _op("op_001_load", [], ["ds1"], "LOAD_CSV"),
+        _op("op_002_compute", ["ds1"], ["ds2"]),
+    ]
+    sps_file = tmp_path / "logic.sps"
+    sps_file.write_text("GET DATA /TYPE=TXT /FILE='data.csv'.\nCOMPUTE x = 1.\n")
+
+    class FakeParser:
+        def parse(self, code):
+            return [code]
+
+    class FakeBuilder:
+        def __init__(self, metadata):
+            pass
+
+        def build(self, ast):
+            return _pipeline(*ops)
+
+    class FakeOptimizer:
+        def optimize(self, pipeline):
+            return pipeline
+
+    commands = []
+
+    def fake_run_command(cmd, log_file):
+        commands.append((cmd, Path(log_file).name))
+        Path(log_file).write_text("ok")
+        if cmd[-1].endswith("04_instrumented_code.R"):
+            block_ids = re.findall(r'^\.etl_profile\("([^"]+)"', Path(cmd[-1]).read_text(), re.M)
+            rows = "".join(f'"{block_id}",1.0,5,40,1\n' for block_id in block_ids)
+            (Path(log_file).parent / "05_runtime_profile.csv").write_text(
+                '"op_id","elapsed_sec","rows","mem_mb","mem_delta_mb"\n' + rows
+            )
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(compiler, "SpssParser", FakeParser)
+    monkeypatch.setattr(compiler, "GraphBuilder", FakeBuilder)
+    monkeypatch.setattr(compiler, "OptimizationCoordinator", FakeOptimizer)
+    monkeypatch.setattr(compiler, "Pipeline", lambda **kw: SimpleNamespace(**kw))
+    monkeypatch.setattr(compiler, "RGenerator", generator)
+    monkeypatch.setattr(compiler, "run_command", fake_run_command)
+    monkeypatch.setattr(compiler, "r_script_parses", lambda *a: parses)
+
+    compile_pipeline(str(sps_file), profile=True)
+    return commands, tmp_path / "dist" / "verification"
+
+
+def test_profile_run_keeps_plain_verification(tmp_path, monkeypatch):
+    """
+    The plain script still produces 05_target_verification.txt; the
+    instrumented copy runs separately and feeds the per-op report.
+    """
+    commands, verification = _run_profiled(tmp_path, monkeypatch, StepGenerator, parses=True)
+
+    logs = {log: cmd for cmd, log in commands}
+    assert logs["05_target_verification.txt"][-1] == os.path.join("dist", "pipeline.R")
+    assert logs["05_profile_run.txt"][-1].endswith("04_instrumented_code.R")
+    assert "etl_profile" not in (tmp_path / "dist" / "pipeline.R").read_text()
+
+    report = yaml.safe_load((verification / "05_profile_report.yaml").read_text())
+    assert report["granularity"] == "operation"
+    assert report["segmentation"] == "generator"
+    assert report["source_mapping"] == "statement_order"
+    assert all(e["profiled"] for e in report["operations"])
+    assert "pipeline_header" in report
+
+
+def test_profile_run_falls_back_when_instrumentation_does_not_parse(tmp_path, monkeypatch, capsys):
+    _, verification = _run_profiled(tmp_path, monkeypatch, StepGenerator, parses=False)
+
+    instrumented = (verification / "04_instrumented_code.R").read_text()
+    assert '.etl_profile("pipeline", character(), {' in instrumented
+    assert '.etl_profile("op_001_load"' not in instrumented
+
+    report = yaml.safe_load((verification / "05_profile_report.yaml").read_text())
+    assert report["granularity"] == "pipeline"
+    assert report["reason"] == "instrumented_script_does_not_parse"
+    assert all(e["included_in"] == "pipeline" for e in report["operations"])
+    assert "profiling whole script" in capsys.readouterr().out
+
+
+def test_profile_run_warns_without_op_blocks(tmp_path, monkeypatch, capsys):
+    _, verification = _run_profiled(tmp_path, monkeypatch, ChainGenerator, parses=True)
+
+    report = yaml.safe_load((verification / "05_profile_report.yaml").read_text())
+    assert report["granularity"] == "pipeline"
+    assert report["reason"] == "no_op_markers"
+    assert "no_op_markers" in capsys.readouterr().out